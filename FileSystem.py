@@ -1,6 +1,10 @@
 from enum import Enum
-from typing import List, Union
+from itertools import chain, islice
+from typing import Iterable, Iterator, List, Tuple, Union
+import bz2
+import lzma
 import threading
+import zlib
 
 class FileState(Enum):
     CLOSED = 0
@@ -8,6 +12,38 @@ class FileState(Enum):
     WRITE = 3
 
 
+def paginate(lines: Iterable[Tuple[str, str]], page_size: int = None) -> str:
+    """
+    Joins one page of lines into a string. lines yields (token, line) pairs
+    and already starts after the cursor of the previous page. When more lines
+    are left the page ends with a 'next: <cursor>' line, the cursor being the
+    token of the last line shown, so the next page resumes right after it.
+    """
+    if page_size is not None and page_size <= 0:
+        raise Exception("Invalid page size.")
+
+    if page_size is None:
+        return "".join(line + "\n" for token, line in lines)
+
+    # read one line past the page to know if there is a next one
+    page = list(islice(lines, page_size + 1))
+    string = "".join(line + "\n" for token, line in page[:page_size])
+    if len(page) > page_size:
+        string += f"next: {page[page_size - 1][0]}\n"
+    return string
+
+
+def parse_index_cursor(cursor: str) -> int:
+    """The position to resume at after a cursor that is an index"""
+    try:
+        start = int(cursor) + 1
+    except ValueError:
+        raise Exception("Invalid cursor.")
+    if start < 0:
+        raise Exception("Invalid cursor.")
+    return start
+
+
 class Node:
     # Node class
     # constructor takes a name and a parent
@@ -46,17 +82,20 @@ class MemoryBlock():
     def __init__(self, size=32):
         self.data = [""] * size
         self.file = None  # the file object that this block belongs to
+        self.compressed = False  # holds compressed bytes rather than text
 
     def __str__(self):
         if self.file is not None:
-            return ", ".join(self.data) + " " + str(self.file.get_path()) + " " + str(len([self.data[i] for i in range(len(self.data)) if self.data[i] != ""]))
+            data = f"<{len(self.data)} compressed bytes>" if self.compressed else ", ".join(self.data)
+            return data + " " + str(self.file.get_path()) + " " + str(len([self.data[i] for i in range(len(self.data)) if self.data[i] != ""]))
         else:
             return ", ".join(self.data) + " " + str(self.file)
 
-    def write(self, data: str, file: 'File'):
+    def write(self, data: str, file: 'File', compressed=False):
         """Write data to the memory block"""
         self.data = list(data)
         self.file = file
+        self.compressed = compressed
 
     def read(self):
         """Read data from the memory block"""
@@ -66,6 +105,7 @@ class MemoryBlock():
         """Clear the memory block"""
         self.data = [""] * len(self.data)
         self.file = None
+        self.compressed = False
 
     def is_empty(self) -> bool:
         """Check if the memory block is empty"""
@@ -76,133 +116,506 @@ class MemoryBlock():
         return self.file is not None
 
 
+# compression codecs available to MemoryMap, as (compress, decompress)
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "bz2": (lambda data, level: bz2.compress(data, level), bz2.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+
+class Chunk():
+    """
+    A run of a file's data stored in one or more blocks. size is the number
+    of characters of data, codec is None when the blocks hold the plain text.
+    """
+
+    def __init__(self, blocks, size: int, codec: str = None):
+        self.blocks = tuple(blocks)
+        self.size = size
+        self.codec = codec
+
+
+def chunk_blocks(chunks: Iterable[Chunk]) -> List[int]:
+    """The block ids used by the chunks, in order"""
+    return [block_id for chunk in chunks for block_id in chunk.blocks]
+
+
+class BlockList():
+    """
+    An immutable version of a file's block list. A writer never changes a
+    published version, it publishes a new one when it finishes. Readers pin
+    the version they are reading so its blocks are not reclaimed under them.
+    """
+
+    def __init__(self, chunks=(), version=0):
+        self.chunks = tuple(chunks)
+        self.blocks = tuple(chunk_blocks(self.chunks))
+        self.size = sum(chunk.size for chunk in self.chunks)
+        self.version = version
+        self.pins = 0  # number of readers currently holding this version
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+
 class MemoryMap():
     """
     A memory map class that stores the data of all the files as memory 
     blocks in a list. Initialize a array of memory blocks with the given block size
+
+    Every file maps to its latest published BlockList. A writer works on a
+    private draft list that is published on commit, and blocks dropped from
+    a version are only cleared once no reader still holds an older version.
+
+    With a compression codec, the data of files of at least threshold
+    characters is stored as chunks of chunk_size characters, each compressed
+    on its own so a read only decompresses the chunks it needs. Smaller
+    files, and chunks that do not shrink, are stored as plain text.
     """
 
-    def __init__(self, block_size=32, num_blocks=16):
+    def __init__(self, block_size=32, num_blocks=16, compression: str = None, level=6, threshold=64, chunk_size=256):
+        if compression is not None and compression not in CODECS:
+            raise Exception("Unknown compression codec.")
+        if compression is not None:
+            # every codec has its own range of levels, let it reject them now
+            # rather than on the first write
+            try:
+                CODECS[compression][0](b"", level)
+            except Exception:
+                raise Exception("Invalid compression level.")
+        if chunk_size <= 0:
+            raise Exception("Chunk size must be positive.")
+
         self.block_size = block_size  # one block can store 32 characters
         # initialize num_blocks memory blocks in a list
         self.blocks: List[MemoryBlock] = [
             MemoryBlock(block_size) for i in range(num_blocks)]
+        self.compression = compression
+        self.level = level
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        # keyed by the File object rather than its path, so moving a file or
+        # a whole directory never touches the map
         self.map = {}
+        self.drafts = {}  # file -> chunk list of the writer in progress
+        self.retired = []  # superseded versions that are still pinned
+        self.pending = set()  # block ids waiting for their readers to leave
+        # guards block allocation and version bookkeeping, never held while
+        # block data is being read
+        self.lock = threading.Lock()
     
     def add_file(self, file: 'File'):
         """Add a file to the memory map"""
-        file_path = file.get_path()
-        self.map[file_path] = []
-
-    def append_file_data(self, file: 'File', data: str):
-        """Append the data of a file to the memory map"""
-
-        # split the data into blocks
-        blocks = []
-        for i in range(0, len(data), self.block_size):
-            if i + self.block_size < len(data):
-                blocks.append(data[i:i+self.block_size])
-            else:
-                blocks.append(data[i:])
-        
-        if len(blocks) == 0:
-            return
-
-        file_path = file.get_path()
-        # if self.map[file_path] is None:
-        #     self.map[file_path] = []
+        self.map[file] = BlockList()
+
+    def begin_write(self, file: 'File'):
+        """Start a draft of the file's block list for a writer"""
+        with self.lock:
+            try:
+                self.drafts[file] = list(self.map[file].chunks)
+            except KeyError:
+                raise Exception("File not found")
+
+    def commit(self, file: 'File'):
+        """Publish the writer's draft as the new version of the file"""
+        with self.lock:
+            draft = self.drafts.pop(file, None)
+            # the file was deleted while it was being written
+            if draft is None or file not in self.map:
+                return
+            self.__publish(file, draft)
+
+    def __publish(self, file: 'File', chunks: List[Chunk]):
+        """Replace the current version of a file, lock must be held"""
+        old = self.map[file]
+        self.map[file] = BlockList(chunks, old.version + 1)
+        self.__retire(old, set(old) - set(chunk_blocks(chunks)))
+
+    def __retire(self, old: BlockList, stale: set):
+        """Free the stale blocks of a superseded version, or defer it while
+        the version is pinned, lock must be held"""
+        self.pending.update(stale)
+        if old.pins > 0:
+            self.retired.append(old)
+        self.__reclaim()
+
+    def __reclaim(self):
+        """Clear pending blocks that no pinned version refers to anymore"""
+        self.retired = [v for v in self.retired if v.pins > 0]
+        live = set()
+        for version in self.retired:
+            live.update(version)
+        for block_id in self.pending - live:
+            self.blocks[block_id].clear()
+        self.pending &= live
+
+    def __pin(self, file: 'File') -> BlockList:
+        with self.lock:
+            try:
+                version = self.map[file]
+            except KeyError:
+                raise Exception("File not found")
+            version.pins += 1
+            return version
+
+    def __unpin(self, version: BlockList):
+        with self.lock:
+            version.pins -= 1
+            if version.pins == 0 and version in self.retired:
+                self.__reclaim()
+
+    def __draft(self, file: 'File'):
+        """Returns the chunks to change and whether they have to be published
+        straight away because no writer has the file open, lock must be held"""
         try:
-            self.map[file_path]
+            self.map[file]
         except KeyError:
             raise Exception("File not found")
 
-        # loops through self.blocks, find the empty blocks adn write the data to the blocks
+        draft = self.drafts.get(file)
+        if draft is None:
+            return list(self.map[file].chunks), True
+        return draft, False
+
+    def __free_blocks(self, count: int, reuse: List[int] = ()) -> List[int]:
+        """Finds count free blocks, taking the reuse ones first, lock must be held"""
+        free = (i for i, block in enumerate(self.blocks)
+                if block.is_empty() and i not in self.pending)
+        block_ids = list(islice(chain(reuse, free), count))
+        if len(block_ids) < count:
+            raise Exception("Not enough memory to add file data")
+        return block_ids
+
+    def __split(self, data: str, size: int) -> List[str]:
+        return [data[i:i+size] for i in range(0, len(data), size)]
+
+    def __store(self, file: 'File', data: str, codec: str = None, reuse: List[int] = ()) -> List[Chunk]:
+        """Write data to free blocks as chunks, compressed with codec if given,
+        writing over the reuse blocks first.
+        Nothing is written if there are not enough free blocks, lock must be held"""
+        # (stored text, characters of data, codec) for every chunk
+        pieces = []
+        if codec is None:
+            for piece in self.__split(data, self.block_size):
+                pieces.append((piece, len(piece), None))
+        else:
+            compress = CODECS[codec][0]
+            for piece in self.__split(data, self.chunk_size):
+                # latin-1 maps every byte to one character of a block
+                stored = compress(piece.encode(), self.level).decode("latin-1")
+                if len(stored) < len(piece):
+                    pieces.append((stored, len(piece), codec))
+                else:
+                    pieces.append((piece, len(piece), None))
+
+        splits = [self.__split(stored, self.block_size) for stored, size, codec in pieces]
+        free = self.__free_blocks(sum(len(split) for split in splits), reuse)
+        free.reverse()
+
+        chunks = []
+        for (stored, size, codec), split in zip(pieces, splits):
+            block_ids = []
+            for text in split:
+                block_id = free.pop()
+                self.blocks[block_id].write(text, file, codec is not None)
+                block_ids.append(block_id)
+            chunks.append(Chunk(block_ids, size, codec))
+        return chunks
+
+    def __decode(self, chunk: Chunk) -> str:
+        stored = "".join([self.blocks[block_id].read() for block_id in chunk.blocks])
+        if chunk.codec is None:
+            return stored
+        return CODECS[chunk.codec][1](stored.encode("latin-1")).decode()
+
+    def __drop(self, file: 'File', chunks: List[Chunk], kept: List[Chunk] = ()):
+        """Clear the blocks of chunks no reader has ever seen, published ones
+        are reclaimed when the draft is published and blocks reused by the
+        kept chunks are left alone, lock must be held"""
+        published = self.map[file].blocks
+        reused = set(chunk_blocks(kept))
+        for block_id in chunk_blocks(chunks):
+            if block_id not in published and block_id not in reused:
+                self.blocks[block_id].clear()
 
-        for i in range(len(self.blocks)):
-            if self.blocks[i].is_empty():
-                self.blocks[i].write(blocks.pop(0), file)
-                self.map[file_path].append(i)
-                if len(blocks) == 0:
-                    break
+    def __reusable(self, file: 'File', chunks: List[Chunk], autocommit: bool) -> List[int]:
+        """The blocks of chunks that can be written over in place when they are
+        replaced: ones no reader has ever seen and, when the change is published
+        straight away, published ones no reader holds, lock must be held"""
+        current = self.map[file]
+        if autocommit and current.pins == 0:
+            held = set(self.pending)
+            for version in self.retired:
+                held.update(version)
+            return [block_id for block_id in chunk_blocks(chunks) if block_id not in held]
+        return [block_id for block_id in chunk_blocks(chunks) if block_id not in current.blocks]
+
+    def __is_compressed(self, chunks: List[Chunk]) -> bool:
+        """Files in compressed mode have chunks spanning many blocks or a codec"""
+        return any(chunk.codec is not None or len(chunk.blocks) > 1 for chunk in chunks)
 
-        if len(blocks) > 0:
-            raise Exception("Not enough memory to add file data")
+    def append_file_data(self, file: 'File', data: str):
+        """Append the data of a file to the memory map"""
+        if len(data) == 0:
+            return
+
+        with self.lock:
+            # without an open writer the change is published right away
+            draft, autocommit = self.__draft(file)
+            size = sum(chunk.size for chunk in draft)
+
+            if self.compression is None or size + len(data) < self.threshold:
+                draft.extend(self.__store(file, data))
+            else:
+                # the chunks at the end that are not full are stored again
+                # with the new data, which also converts a file that just
+                # reached the threshold. Their blocks are reused where no
+                # reader can see them, so a full map can still be appended to
+                keep = len(draft)
+                while keep > 0 and draft[keep - 1].size < self.chunk_size:
+                    keep -= 1
+                tail = draft[keep:]
+                text = "".join(self.__decode(chunk) for chunk in tail) + data
+                chunks = self.__store(file, text, self.compression, self.__reusable(file, tail, autocommit))
+                self.__drop(file, tail, chunks)
+                draft[keep:] = chunks
+
+            if autocommit:
+                self.__publish(file, draft)
 
     def truncate_file_data(self, file: 'File', size: int):
-        """Truncate the data of a file to the memory map equal to the given size (num of blocks)"""
-        file_path = file.get_path()
-        try:
-            self.map[file_path]
-        except KeyError:
-            raise Exception("File not found")
-        if len(self.map[file_path]) < size:
-            raise Exception("File size is smaller than the given size")
-        # loops through self.blocks, find the empty blocks adn write the data to the blocks
-        for i in range(size):
-            self.blocks[self.map[file_path][(i + 1) * -1]].clear()
-        self.map[file_path] = self.map[file_path][:size * -1]
+        """Truncate the data of a file to the memory map equal to the given size (num of blocks).
+        For compressed files this removes size blocks' worth of characters."""
+        with self.lock:
+            draft, autocommit = self.__draft(file)
+
+            if not self.__is_compressed(draft):
+                if len(draft) < size:
+                    raise Exception("File size is smaller than the given size")
+                removed, kept = draft[len(draft) - size:], draft[:len(draft) - size]
+            else:
+                remove = size * self.block_size
+                if sum(chunk.size for chunk in draft) < remove:
+                    raise Exception("File size is smaller than the given size")
+                kept = list(draft)
+                removed = []
+                while remove > 0 and kept[-1].size <= remove:
+                    remove -= kept[-1].size
+                    removed.append(kept.pop())
+                if remove > 0:
+                    # only part of the last chunk goes, store the rest again
+                    last = kept.pop()
+                    text = self.__decode(last)[:last.size - remove]
+                    kept.extend(self.__store(file, text, self.compression, self.__reusable(file, [last], autocommit)))
+                    removed.append(last)
+
+            self.__drop(file, removed, kept)
+
+            if autocommit:
+                self.__publish(file, kept)
+            else:
+                self.drafts[file] = kept
 
     def delete_file_data(self, file: 'File'):
-        file_path = file.get_path()
+        self.delete_files_data([file])
+
+    def delete_files_data(self, files: List['File']):
+        """Delete the data of many files at once, their blocks are returned
+        to the free pool in one pass"""
+        with self.lock:
+            for file in files:
+                if file not in self.map:
+                    raise Exception("File not found")
+
+            for file in files:
+                current = self.map.pop(file)
+                for block_id in chunk_blocks(self.drafts.pop(file, [])):
+                    if block_id not in current.blocks:
+                        self.blocks[block_id].clear()
+                self.pending.update(current)
+                if current.pins > 0:
+                    self.retired.append(current)
+            self.__reclaim()
+
+    def copy_files_data(self, pairs: List[Tuple['File', 'File']]):
+        """Copy the published data of each source file to its new destination
+        file, nothing is copied if there are not enough free blocks for all"""
+        with self.lock:
+            for src, dest in pairs:
+                if src not in self.map:
+                    raise Exception("File not found")
+
+            free = self.__free_blocks(sum(len(self.map[src]) for src, dest in pairs))
+            free.reverse()
+            for src, dest in pairs:
+                # chunks are copied as stored, compressed ones stay compressed
+                chunks = []
+                for chunk in self.map[src].chunks:
+                    block_ids = []
+                    for block_id in chunk.blocks:
+                        new_id = free.pop()
+                        self.blocks[new_id].write(self.blocks[block_id].read(), dest, chunk.codec is not None)
+                        block_ids.append(new_id)
+                    chunks.append(Chunk(block_ids, chunk.size, chunk.codec))
+                self.map[dest] = BlockList(chunks)
+
+    def read_file_data(self, file: 'File', offset: int = 0, size: int = None):
+        """Read the latest published version of a file without blocking on its writer.
+        Only the chunks overlapping offset and size are decompressed."""
+        version = self.__pin(file)
         try:
-            self.map[file_path]
-        except KeyError:
-            raise Exception("File not found")
-        else:
-            for block_id in self.map[file_path]:
-                self.blocks[block_id].clear()
-
-    def read_file_data(self, file: 'File'):
-        file_path = file.get_path()
-        try:
-            self.map[file_path]
-        except KeyError:
-            raise Exception("File not found")
-
-        return "".join([self.blocks[block_id].read() for block_id in self.map[file_path]])
+            end = version.size if size is None else offset + size
+            data = []
+            start = 0  # position of the current chunk in the file
+            for chunk in version.chunks:
+                if start >= end:
+                    break
+                if start + chunk.size > offset:
+                    text = self.__decode(chunk)
+                    data.append(text[max(offset - start, 0):end - start])
+                start += chunk.size
+            return "".join(data)
+        finally:
+            self.__unpin(version)
+
+    def stats(self):
+        """Returns the characters of data in all the files, the characters used
+        to store them and the number of blocks they take"""
+        with self.lock:
+            versions = list(self.map.values())
+        size, stored, blocks = 0, 0, 0
+        for version in versions:
+            size += version.size
+            blocks += len(version)
+            stored += sum(len(self.blocks[block_id].data) for block_id in version)
+        return size, stored, blocks
+
+    def check_consistency(self, files: List['File']) -> List[str]:
+        """Checks that the map, the versions and the blocks agree with each other
+        and with the given files of the tree, returns the problems found"""
+        problems = []
+        with self.lock:
+            files = set(files)
+            for file in files - self.map.keys():
+                problems.append(f"{file.get_path()}: file has no memory map entry")
+            for file in self.map.keys() - files:
+                problems.append(f"{file.get_path()}: memory map entry has no file in the tree")
+            for file in self.drafts.keys() - self.map.keys():
+                problems.append(f"{file.get_path()}: draft has no memory map entry")
+            for file in self.drafts.keys():
+                if not file.writing:
+                    problems.append(f"{file.get_path()}: draft has no writer, it will never be published")
+            for file in self.map.keys():
+                if file.writing and file not in self.drafts:
+                    problems.append(f"{file.get_path()}: open for writing but has no draft")
+
+            owners = {}  # block id -> file whose version refers to it
+            for file, version in self.map.items():
+                path = file.get_path()
+                referenced = set(version) | set(chunk_blocks(self.drafts.get(file, [])))
+                if len(version.blocks) != len(set(version.blocks)):
+                    problems.append(f"{path}: version {version.version} refers to a block twice")
+                for block_id in referenced:
+                    if block_id in owners:
+                        problems.append(f"block {block_id}: shared by {owners[block_id].get_path()} and {path}")
+                    owners[block_id] = file
+                    block = self.blocks[block_id]
+                    if block.is_empty():
+                        problems.append(f"block {block_id}: referenced by {path} but empty")
+                    elif block.file is not file:
+                        problems.append(f"block {block_id}: referenced by {path} but owned by {block.file.get_path()}")
+
+            retained = set(self.pending)
+            for version in self.retired:
+                retained.update(version)
+            for block_id, block in enumerate(self.blocks):
+                if block.is_occupied() and block_id not in owners and block_id not in retained:
+                    problems.append(f"block {block_id}: occupied but not referenced (leaked)")
+        return problems
+
+    def iter_visualise(self, after: str = None) -> Iterator[Tuple[str, str]]:
+        """Yields (block index, line) for every memory block after the cursor"""
+        start = 0 if after is None else parse_index_cursor(after)
+        for i in range(start, len(self.blocks)):
+            yield str(i), str(self.blocks[i])
+
+    def iter_summary(self, after: str = None) -> Iterator[Tuple[str, str]]:
+        """Yields the ranges of consecutive blocks that belong to the same file
+        (or are free) instead of every block, followed by the occupancy.
+        A range's token is its last block, the occupancy line comes as block
+        count and the compression line after it."""
+        count = len(self.blocks)
+        start = 0 if after is None else parse_index_cursor(after)
+        owner = None
+        for i in range(start, count):
+            block = self.blocks[i]
+            if i > start and block.file is not owner:
+                yield str(i - 1), self.__summary_range(start, i - 1, owner)
+                start = i
+            owner = block.file
+        if start < count:
+            yield str(count - 1), self.__summary_range(start, count - 1, owner)
+        if start <= count:
+            used = sum(1 for block in self.blocks if block.is_occupied())
+            yield str(count), f"{used}/{count} blocks occupied"
+
+        size, stored, blocks = self.stats()
+        if start <= count + 1 and stored > 0:
+            yield str(count + 1), f"{size} characters stored in {stored} ({blocks} blocks), compression ratio {size / stored:.2f}"
+
+    def __summary_range(self, start: int, end: int, owner: 'File') -> str:
+        return f"{start}-{end} " + ("free" if owner is None else owner.get_path())
 
     def visualise(self):
-        string = ""
-        for block in self.blocks:
-            string += str(block) + "\n"
-        return string
+        return "".join(line + "\n" for token, line in self.iter_visualise())
 
 class File(Node):
     def __init__(self, name: str, parent: Directory = None) -> None:
         super().__init__(name, parent)
-        self.state: FileState = FileState.CLOSED
         self.readers = 0
+        self.writing = False
         self.red = threading.Semaphore()
         self.write = threading.Semaphore()
 
+    @property
+    def state(self) -> FileState:
+        if self.writing:
+            return FileState.WRITE
+        if self.readers > 0:
+            return FileState.READ
+        return FileState.CLOSED
+
+    def is_open(self, mode) -> bool:
+        """Check if the file is open in the given mode, readers and a writer
+        can have the file open at the same time"""
+        if mode == "r":
+            return self.readers > 0
+        return self.writing
+
     def request_read(self):
+        # readers only count themselves, they read a published version and
+        # never wait for the writer
         self.red.acquire()
         self.readers = self.readers + 1
-
-        # if atleast one reader in critical section no writer can enter (preference to readers)
-        if self.readers == 1:
-            self.write.acquire()
-            self.mode = "r"
-
-        self.red.release()  # other readers can enter
+        self.red.release()
 
     def release_read(self):
-        self.red.acquire()  # reader wants to leave
-        self.readers = self.readers - 1
-
-        if self.readers == 0:
-            self.mode = None
-            self.write.release()
-            # writers can enter if no readers left in critical section
-
-        self.red.release()  # reader leaves
+        self.red.acquire()
+        if self.readers > 0:
+            self.readers = self.readers - 1
+        self.red.release()
 
     def request_write(self):
+        # one writer at a time
         self.write.acquire()
-        self.mode = "w"
+        self.writing = True
 
     def release_write(self):
-        self.mode = None
+        self.writing = False
         self.write.release()
 
     def open(self, mode):
@@ -211,33 +624,29 @@ class File(Node):
 
         if mode == "r":
             self.request_read()
-            self.state = FileState.READ
         elif mode == "w":
             self.request_write()
-            self.state = FileState.WRITE
 
-    def close(self):
-        if self.mode == "r":
+    def close(self, mode):
+        if mode == "r":
             self.release_read()
-        elif self.mode == "w":
+        elif mode == "w" and self.writing:
             self.release_write()
-        
-        self.state = FileState.CLOSED
    
     def append(self, mmap: MemoryMap, data: str):
-        if self.state != FileState.WRITE:
+        if not self.is_open("w"):
             raise Exception("File is not open for writing")
         else:
             mmap.append_file_data(self, data)
 
     def read(self, mmap: MemoryMap):
-        if self.state != FileState.READ:
+        if not self.is_open("r"):
             raise Exception("File is not open for reading")
         else:
             return mmap.read_file_data(self)
 
     def truncate(self, mmap: MemoryMap, size: int):
-        if self.state != FileState.WRITE:
+        if not self.is_open("w"):
             raise Exception("File is not open for writing")
         else:
             mmap.truncate_file_data(self, size)
@@ -254,8 +663,8 @@ class FileSystem:
     - names ending in .[ext] will be files and without the . will be directories
     """
 
-    def __init__(self, block_size=32, num_blocks=16):
-        self.mmap = MemoryMap(block_size, num_blocks)
+    def __init__(self, block_size=32, num_blocks=16, compression: str = None, level=6, threshold=64, chunk_size=256):
+        self.mmap = MemoryMap(block_size, num_blocks, compression, level, threshold, chunk_size)
         self.root = Directory("/")
 
     def get_dir(self, path: str):
@@ -303,6 +712,15 @@ class FileSystem:
                 return child
         return None
 
+    def get_node(self, path: str) -> Node or None:
+        """Returns the file or directory at path, names with a . are files"""
+        if "." in path.split("/")[-1]:
+            return self.get_file(path)
+        return self.get_dir(path)
+
+    def __does_not_exist(self, path: str) -> str:
+        return "File does not exist." if "." in path.split("/")[-1] else "Directory does not exist."
+
     def mkdir(self, path: str):
         split_path = path.split("/")
         parent_path, dname = "/".join(split_path[:-1]), split_path[-1]
@@ -342,15 +760,32 @@ class FileSystem:
             raise Exception("File does not exist.")
 
         file.open(mode)
-        return True
+        if mode == "w":
+            try:
+                self.mmap.begin_write(file)
+            except Exception:
+                # the file was deleted while waiting for the write lock
+                file.close("w")
+                raise
+        return file
     
-    def close(self, path: str):
+    def close(self, path: str, mode: str):
+        """Closes the file opened in mode, a writer publishes its changes to
+        readers here. The mode is never guessed, closing the wrong one would
+        release another user's lock"""
         file = self.get_file(path)
 
         if file is None:
             raise Exception("File does not exist.")
 
-        file.close()
+        return self.close_file(file, mode)
+
+    def close_file(self, file: File, mode: str):
+        """Closes a file that was opened earlier, even if it has been moved or
+        deleted since"""
+        if mode == "w" and file.writing:
+            self.mmap.commit(file)
+        file.close(mode)
         return True
 
     def write(self, path: str, data: str):
@@ -360,23 +795,35 @@ class FileSystem:
 
         if file is None:
             raise Exception("File does not exist.")
-        
-        if (file.state != FileState.WRITE):
+
+        return self.write_file(file, data)
+
+    def write_file(self, file: File, data: str):
+        """Appends to a file that was opened earlier, even if it has been moved since"""
+        if not file.is_open("w"):
             raise Exception("File is not open for writing.")
 
         self.mmap.append_file_data(file, data)
         return True
 
-    def read(self, path: str):
+    def read(self, path: str, offset: int = 0, size: int = None):
+        """Reads the file, or size characters of it from offset"""
         file = self.get_file(path)
 
         if file is None:
             raise Exception("File does not exist.")
-        
-        if (file.state != FileState.READ):
+
+        return self.read_file(file, offset, size)
+
+    def read_file(self, file: File, offset: int = 0, size: int = None):
+        """Reads a file that was opened earlier, even if it has been moved since"""
+        if not file.is_open("r"):
             raise Exception("File is not open for reading.")
         
-        data = self.mmap.read_file_data(file)
+        if offset < 0 or (size is not None and size < 0):
+            raise Exception("Invalid offset or size.")
+
+        data = self.mmap.read_file_data(file, offset, size)
 
         return data
 
@@ -386,7 +833,7 @@ class FileSystem:
         if file is None:
             raise Exception("File does not exist.")
         
-        if (file.state != FileState.WRITE):
+        if not file.is_open("w"):
             raise Exception("File is not open for writing.")
 
        
@@ -394,14 +841,25 @@ class FileSystem:
    
         return True
 
-    def delete(self, path: str):
-        file = self.get_file(path)
+    def delete(self, path: str, recursive=False):
+        """Deletes a file, or with recursive a directory and everything in it"""
+        node = self.get_node(path)
 
-        if file is None:
-            raise Exception("File does not exist.")
+        if node is None:
+            raise Exception(self.__does_not_exist(path))
 
-        self.mmap.delete_file_data(file)
-        file.parent.remove_child(file)
+        if isinstance(node, Directory):
+            if node is self.root:
+                raise Exception("Cannot remove the root directory.")
+            if not recursive:
+                raise Exception("Cannot remove a directory without -r.")
+            files = [n for level, n in self.walk(node) if isinstance(n, File)]
+        else:
+            files = [node]
+
+        # free all the blocks in one go, then unlink the subtree from the tree
+        self.mmap.delete_files_data(files)
+        node.parent.remove_child(node)
         return True
     
     def ls(self, path: str):
@@ -411,58 +869,219 @@ class FileSystem:
             raise Exception("Directory does not exist.")
 
         return dir.children
-    
-    def mv(self, src: str, dest: str):
-        file = self.get_file(src)
-        src_file_path = file.get_path()
 
-        if file is None:
-            raise Exception("File does not exist.")
+    def iter_ls(self, path: str, after: str = None) -> Iterator[Tuple[str, str]]:
+        """Yields (name, line) for the entries of the directory after the one
+        named by the cursor, directories end with a /"""
+        children = list(self.ls(path))
+        start = 0
+        if after is not None:
+            names = [child.name for child in children]
+            if after not in names:
+                raise Exception("Invalid cursor.")
+            start = names.index(after) + 1
+        for child in children[start:]:
+            yield child.name, child.name + "/" if isinstance(child, Directory) else child.name
+    
+    def __destination(self, node: Node, dest: str):
+        """Resolves dest for mv and cp, returns the parent directory and the
+        name node will have there. dest is either an existing directory to
+        move into or the new path of node."""
+        name = dest.split("/")[-1]
+        if "." not in name:
+            parent = self.get_dir(dest)
+            if parent is not None:
+                name = node.name
+            elif isinstance(node, File):
+                raise Exception("Destination directory does not exist.")
+            else:
+                parent = self.get_dir("/".join(dest.split("/")[:-1]))
+        elif isinstance(node, Directory):
+            raise Exception("Invalid name for a directory.")
+        else:
+            parent = self.get_dir("/".join(dest.split("/")[:-1]))
 
-        parent = self.get_dir(dest)
         if parent is None:
             raise Exception("Destination directory does not exist.")
+        if parent.get_child(name) is not None:
+            raise Exception("Destination already exists.")
+        return parent, name
+
+    def mv(self, src: str, dest: str):
+        """Moves or renames a file or a directory. Only the node is relinked,
+        the data of the files under it is not touched."""
+        node = self.get_node(src)
+
+        if node is None:
+            raise Exception(self.__does_not_exist(src))
+        if node is self.root:
+            raise Exception("Cannot move the root directory.")
+
+        parent, name = self.__destination(node, dest)
+
+        # a directory can not be moved below itself
+        ancestor = parent
+        while ancestor is not None:
+            if ancestor is node:
+                raise Exception("Cannot move a directory into itself.")
+            ancestor = ancestor.parent
+
+        node.parent.remove_child(node)
+        node.name = name
+        node.parent = parent
+        parent.add_child(node)
+        return True
+
+    def cp(self, src: str, dest: str, recursive=False):
+        """Copies a file, or with recursive a directory and everything in it"""
+        node = self.get_node(src)
+
+        if node is None:
+            raise Exception(self.__does_not_exist(src))
+        if isinstance(node, Directory) and not recursive:
+            raise Exception("Cannot copy a directory without -r.")
+
+        parent, name = self.__destination(node, dest)
+
+        # build the copy detached from the tree, so nothing is left behind
+        # if there is not enough memory for the data
+        copies = {}
+        pairs = []
+        for level, child in self.walk(node):
+            copy_parent = copies.get(child.parent) if level > 0 else None
+            copy_name = child.name if level > 0 else name
+            if isinstance(child, Directory):
+                copy = Directory(copy_name, copy_parent)
+            else:
+                copy = File(copy_name, copy_parent)
+                pairs.append((child, copy))
+            if copy_parent is not None:
+                copy_parent.add_child(copy)
+            copies[child] = copy
 
-        file.parent.remove_child(file)
-        file.parent = parent
-        parent.add_child(file)
+        self.mmap.copy_files_data(pairs)
 
-        # change the mmap
-        self.mmap.map[file.get_path()] = self.mmap.map[src_file_path]
-        del self.mmap.map[src_file_path]
+        copy = copies[node]
+        copy.parent = parent
+        parent.add_child(copy)
         return True
 
-    def visualise_tree(self):
+    def check_consistency(self) -> List[str]:
+        """Checks the tree and the memory map against each other, returns the problems found"""
+        problems = []
+        files = []
+
+        def check_helper(dir: Directory):
+            names = set()
+            for child in list(dir.children):
+                if child.parent is not dir:
+                    problems.append(f"{dir.get_path()}/{child.name}: parent pointer does not match")
+                if child.name in names:
+                    problems.append(f"{child.get_path()}: duplicate name in directory")
+                names.add(child.name)
+                if isinstance(child, Directory):
+                    check_helper(child)
+                else:
+                    files.append(child)
+
+        check_helper(self.root)
+        return problems + self.mmap.check_consistency(files)
+
+    def walk(self, dir: Directory, max_depth: int = None, after: str = None) -> Iterator[Tuple[int, Node]]:
+        """Yields (level, node) for the directory and everything below it
+        in depth first order, down to max_depth levels below it. With a
+        cursor, the path of a node of the walk, it continues after that node"""
+        stack = [(0, dir)] if after is None else self.__resume_walk(dir, max_depth, after)
+        while len(stack) > 0:
+            level, node = stack.pop()
+            yield level, node
+            if isinstance(node, Directory) and (max_depth is None or level < max_depth):
+                stack.extend((level + 1, child) for child in reversed(list(node.children)))
+
+    def __resume_walk(self, dir: Directory, max_depth: int, after: str) -> list:
+        """Rebuilds the stack walk() would have right after yielding the node
+        at the cursor: the siblings after it and after each of its ancestors,
+        and its children on top"""
+        try:
+            node = self.get_node(after.lstrip("/"))
+        except Exception:
+            node = None
+        ancestors = []  # the node and its ancestors up to dir, deepest first
+        while node is not None and node is not dir:
+            ancestors.append(node)
+            node = node.parent
+        if node is None or (max_depth is not None and len(ancestors) > max_depth):
+            raise Exception("Invalid cursor.")
+
+        stack = []
+        for level, node in enumerate(reversed(ancestors), 1):
+            siblings = list(node.parent.children)
+            stack.extend((level, sibling) for sibling in reversed(siblings[siblings.index(node) + 1:]))
+        node = ancestors[0] if len(ancestors) > 0 else dir
+        if isinstance(node, Directory) and (max_depth is None or len(ancestors) < max_depth):
+            stack.extend((len(ancestors) + 1, child) for child in reversed(list(node.children)))
+        return stack
+
+    def iter_tree(self, path: str = "", max_depth: int = None, after: str = None) -> Iterator[Tuple[str, str]]:
+        """Yields (path, line) for the tree under path, after the cursor"""
+        dir = self.get_dir(path)
+        if dir is None:
+            raise Exception("Directory does not exist.")
+
+        for level, node in self.walk(dir, max_depth, after):
+            yield node.get_path() or "/", "---"*level + node.name
+
+    def iter_tree_summary(self, path: str = "", max_depth: int = None, after: str = None) -> Iterator[Tuple[str, str]]:
+        """Yields (path, line) for every directory, after the cursor, with the
+        number of directories, files and memory blocks directly inside it"""
+        dir = self.get_dir(path)
+        if dir is None:
+            raise Exception("Directory does not exist.")
+
+        for level, node in self.walk(dir, max_depth, after):
+            if not isinstance(node, Directory):
+                continue
+            dirs, files, blocks = 0, 0, 0
+            for child in list(node.children):
+                if isinstance(child, Directory):
+                    dirs += 1
+                else:
+                    files += 1
+                    blocks += len(self.mmap.map.get(child, ()))
+            yield node.get_path() or "/", f"{node.get_path() or '/'}: {dirs} dirs, {files} files, {blocks} blocks"
+
+    def visualise_tree(self, path: str = "", max_depth: int = None):
         """Prints the file system in a tree format"""
-        def visualise_helper(node, level):
-            string = "---"*level + node.name + "\n"
-            # check if node is a directory
-            if isinstance(node, Directory):
-                for child in node.children:
-                    string += visualise_helper(child, level+1)
-            return string
-        return visualise_helper(self.root, 0)
+        return paginate(self.iter_tree(path, max_depth))
 
     def visualise_mmap(self):
         """Prints the memory map"""
         return self.mmap.visualise()
 
     def store_state(self):
-        """Stores the state of the file system to a file"""
+        """Stores the state of the file system to a file, files are read from
+        their published versions so active writers are never waited on"""
         def store_helper(node: Directory or File):
             if isinstance(node, Directory):
+                children = [store_helper(child) for child in list(node.children)]
                 return {
                     "type": "dir",
                     "name": node.name,
                     "path": node.get_path(),
-                    "children": [store_helper(child) for child in node.children]
+                    "children": [child for child in children if child is not None]
                 }
             else:
+                try:
+                    data = self.mmap.read_file_data(node)
+                except Exception:
+                    # deleted after it was listed, its data leaves the map
+                    # before the file leaves the tree
+                    return None
                 return {
                     "type": "file",
                     "name": node.name,
                     "path": node.get_path(),
-                    "data": self.mmap.read_file_data(node)
+                    "data": data
                 }
         return store_helper(self.root)
     
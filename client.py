@@ -1,23 +1,362 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import queue
+import shlex
 import socket
+import threading
+from typing import List
+import protocol
+
+PORT = 95
+
+
+class ServerError(Exception):
+    """Raised when the server reports that a command failed"""
+
+
+def build_command(*args) -> str:
+    """Joins the arguments into a command line, quoting any that contain whitespace"""
+    return " ".join(shlex.quote(str(arg)) for arg in args)
+
+
+def check_response(message) -> str:
+    if message is None:
+        raise ConnectionError("Connection closed by the server")
+    status, data = message
+    if status == protocol.ERROR:
+        raise ServerError(data)
+    return data
+
+
+def page_options(page_size: int = None, cursor: str = None) -> list:
+    options = []
+    if page_size is not None:
+        options += ["-n", page_size]
+    if cursor is not None:
+        options += ["-c", cursor]
+    return options
+
+
+def split_page(response: str):
+    """Splits a paged response into its lines and the cursor of the next
+    page, which is None on the last page"""
+    lines = response.splitlines()
+    if len(lines) > 0 and lines[-1].startswith("next: "):
+        return lines[:-1], lines.pop()[len("next: "):]
+    return lines, None
+
+
+class Commands:
+    """
+    The Executor command set, shared by the sync and async clients.
+    Subclasses implement request(), which may return a value or an awaitable.
+
+    Files are opened on the connection that opens them, so an open, its writes
+    and the close should go through the same client.
+    """
+
+    def request(self, *args):
+        raise NotImplementedError
+
+    def mkdir(self, path: str):
+        return self.request("mkdir", path)
+
+    def touch(self, path: str):
+        return self.request("touch", path)
+
+    def open(self, path: str, mode="r"):
+        return self.request("open", path, mode)
+
+    def close(self, path: str):
+        return self.request("close", path)
+
+    def write(self, path: str, data: str):
+        return self.request("write", path, data)
+
+    def read(self, path: str, offset: int = None, size: int = None):
+        args = [] if offset is None else [offset]
+        if size is not None:
+            args = [offset or 0, size]
+        return self.request("read", path, *args)
+
+    def ls(self, path: str = "", page_size: int = None, cursor: str = None):
+        return self.request("ls", path, *page_options(page_size, cursor))
+
+    def mv(self, src: str, dest: str):
+        return self.request("mv", src, dest)
+
+    def cp(self, src: str, dest: str, recursive=False):
+        return self.request("cp", *(["-r"] if recursive else []), src, dest)
+
+    def rm(self, path: str, recursive=False):
+        return self.request("rm", *(["-r"] if recursive else []), path)
+
+    def vtree(self, path: str = "", depth: int = None, summary=False, page_size: int = None, cursor: str = None):
+        options = [] if depth is None else ["-d", depth]
+        if summary:
+            options.append("-s")
+        return self.request("vtree", path, *options, *page_options(page_size, cursor))
+
+    def vmap(self, summary=False, page_size: int = None, cursor: str = None):
+        options = ["-s"] if summary else []
+        return self.request("vmap", *options, *page_options(page_size, cursor))
+
+    def fsck(self):
+        return self.request("fsck")
+
+    def profile(self, action: str, seconds: float = None, interval_ms: float = None):
+        args = [] if seconds is None else [seconds]
+        if interval_ms is not None:
+            args = [seconds if seconds is not None else 0, interval_ms]
+        return self.request("profile", action, *args)
+
+    def trace(self, action: str, seconds: float = None):
+        return self.request("trace", action, *([] if seconds is None else [seconds]))
+
+
+class Client(Commands):
+    """
+    A blocking connection to the server, safe to share between threads.
+    With a timeout, a request the server does not answer in time raises
+    socket.timeout and the connection should be discarded.
+    """
+
+    def __init__(self, host="localhost", port=PORT, name="client", timeout=None):
+        self.name = name
+        self.socket = socket.create_connection((host, port), timeout)
+        # requests are small and often pipelined, don't let Nagle hold them back
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        protocol.send_message(self.socket, name)
+        self.welcome = check_response(protocol.recv_message(self.socket))
+
+    def request(self, *args) -> str:
+        """Sends one command and waits for its response"""
+        with self.lock:
+            protocol.send_message(self.socket, build_command(*args))
+            return check_response(protocol.recv_message(self.socket))
+
+    def pipeline(self, commands: List[tuple], raise_errors=True) -> list:
+        """
+        Sends all the commands before reading any response. Returns the
+        responses in order, failed commands give a ServerError in their place
+        unless raise_errors is set.
+        """
+        with self.lock:
+            self.socket.sendall(b"".join(
+                protocol.encode_message(build_command(*command)) for command in commands))
+            responses = []
+            for _ in commands:
+                try:
+                    responses.append(check_response(protocol.recv_message(self.socket)))
+                except ServerError as e:
+                    responses.append(e)
+        if raise_errors:
+            for response in responses:
+                if isinstance(response, ServerError):
+                    raise response
+        return responses
+
+    def disconnect(self):
+        with self.lock:
+            try:
+                protocol.send_message(self.socket, "exit")
+            except OSError:
+                pass
+            self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.disconnect()
+
+
+class ClientPool(Commands):
+    """
+    A fixed size pool of blocking clients. Single commands borrow any idle
+    connection, use connection() to keep one for an open/write/close sequence.
+    """
+
+    def __init__(self, host="localhost", port=PORT, name="client", size=4):
+        self.clients = [Client(host, port, f"{name}-{i}") for i in range(size)]
+        self.idle = queue.Queue()
+        for client in self.clients:
+            self.idle.put(client)
+
+    @contextlib.contextmanager
+    def connection(self):
+        client = self.idle.get()
+        try:
+            yield client
+        finally:
+            self.idle.put(client)
+
+    def request(self, *args) -> str:
+        with self.connection() as client:
+            return client.request(*args)
+
+    def disconnect(self):
+        for client in self.clients:
+            client.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.disconnect()
+
+
+class AsyncClient(Commands):
+    """
+    An asyncio connection to the server. Concurrent requests are pipelined
+    on the one socket and matched to their responses in order.
+    """
+
+    def __init__(self, host="localhost", port=PORT, name="client"):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.reader = None
+        self.writer = None
+        self.waiting = collections.deque()  # futures of in flight requests
+        self.reader_task = None
+        self.welcome = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(protocol.encode_message(self.name))
+        self.welcome = check_response(await protocol.read_message(self.reader))
+        self.reader_task = asyncio.ensure_future(self.__read_responses())
+        return self
+
+    async def __read_responses(self):
+        try:
+            while True:
+                message = await protocol.read_message(self.reader)
+                if message is None:
+                    break
+                future = self.waiting.popleft()
+                if not future.cancelled():
+                    future.set_result(message)
+        finally:
+            # however the loop ended, nothing will answer the rest
+            while self.waiting:
+                future = self.waiting.popleft()
+                if not future.cancelled():
+                    future.set_exception(ConnectionError("Connection closed by the server"))
+
+    @property
+    def closed(self) -> bool:
+        """True once the connection is gone, nothing would answer a request"""
+        return self.reader_task is None or self.reader_task.done()
+
+    async def request(self, *args) -> str:
+        if self.closed:
+            raise ConnectionError("Connection closed by the server")
+        future = asyncio.get_running_loop().create_future()
+        # appending and writing happen without awaiting in between, so the
+        # order of self.waiting is the order on the wire
+        self.waiting.append(future)
+        self.writer.write(protocol.encode_message(build_command(*args)))
+        await self.writer.drain()
+        return check_response(await future)
+
+    async def pipeline(self, commands: List[tuple], raise_errors=True) -> list:
+        return await asyncio.gather(
+            *[self.request(*command) for command in commands],
+            return_exceptions=not raise_errors)
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        if not self.closed:
+            try:
+                self.writer.write(protocol.encode_message("exit"))
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+        self.writer.close()
+        await self.reader_task
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+
+class AsyncClientPool(Commands):
+    """
+    A pool of asyncio clients. Since every connection pipelines, single
+    commands are spread over the connections round robin; connection()
+    hands out one connection exclusively for an open/write/close sequence.
+    """
+
+    def __init__(self, host="localhost", port=PORT, name="client", size=4):
+        self.clients = [AsyncClient(host, port, f"{name}-{i}") for i in range(size)]
+        self.next_client = itertools.cycle(self.clients)
+        self.checked_out = set()  # clients handed out by connection()
+        self.idle = None
+
+    async def connect(self):
+        await asyncio.gather(*[client.connect() for client in self.clients])
+        self.idle = asyncio.Queue()
+        for client in self.clients:
+            self.idle.put_nowait(client)
+        return self
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        client = await self.idle.get()
+        self.checked_out.add(client)
+        try:
+            yield client
+        finally:
+            self.checked_out.discard(client)
+            self.idle.put_nowait(client)
+
+    async def request(self, *args) -> str:
+        # round robin over the clients nobody has checked out, if they all
+        # are, wait for one to come back
+        for _ in range(len(self.clients)):
+            client = next(self.next_client)
+            if client not in self.checked_out:
+                return await client.request(*args)
+        async with self.connection() as client:
+            return await client.request(*args)
+
+    async def disconnect(self):
+        await asyncio.gather(*[client.disconnect() for client in self.clients])
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
 
 def print_protocol():
     print("mkdir <path> - creates a directory at path")
     print("touch <path> - creates a file at path")
-    print("ls <path> - lists the contents of the directory at path")
+    print("ls [path] [-n page_size] [-c cursor] - lists the contents of the directory at path")
     print("mv <old_path> <new_path> - moves the file or directory at old_path to new_path")
-    print("rm <path> - removes the file or directory at path")
+    print("cp [-r] <old_path> <new_path> - copies the file, or with -r the directory, at old_path")
+    print("rm [-r] <path> - removes the file, or with -r the directory, at path")
     print("open <path> r/w - opens the file at path for reading or writing")
     print("close <path> - closes the file at path")
     print("write <path> <data> - writes data to the file at opened path")
-    print("read <path> - reads data from the file at opened path")
-    print("vtree - prints the file system in a tree format")
-    print("vmap - prints the memory map of the file system")
+    print("read <path> [offset] [size] - reads data from the file at opened path")
+    print("vtree [path] [-d depth] [-s] [-n page_size] [-c cursor] - prints the file system in a tree format, -s for a summary")
+    print("vmap [-s] [-n page_size] [-c cursor] - prints the memory map of the file system, -s for a summary")
     print("help - prints this message")
     print("exit - exits the program")
 
 def get_command():
-    while True:    
-        
+    while True:
+
         print("\nEnter a command: ", end="")
 
         command = input()
@@ -30,39 +369,46 @@ def get_command():
             return command
 
 
+def main():
+    # Create a TCP/IP socket
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+    server = input("Enter the server address: ")
 
-# Create a TCP/IP socket
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Connect the socket to the server
+    client_socket.connect((server, PORT))
 
-server = input("Enter the server address: ")
+    # ask for name of the client and send it to the server
+    name = input("Enter your name: ")
+    protocol.send_message(client_socket, name)
 
-# Connect the socket to the server
-client_socket.connect((server, 95))
+    # wait for the server to send the welcome message
+    status, data = protocol.recv_message(client_socket)
+    print(data)
 
-# ask for name of the client and send it to the server
-name = input("Enter your name: ")
-client_socket.send(name.encode())
+    print_protocol()
 
-# wait for the server to send the welcome message
-data = client_socket.recv(1024)
-print(data.decode())
+    while True:
+        # Send data
+        command = get_command()
 
-print_protocol()
+        if command[0] == "exit":
+            protocol.send_message(client_socket, "exit")
+            break
 
-while True:
-    # Send data
-    command = get_command()
+        protocol.send_message(client_socket, " ".join(command))
 
-    if command[0] == "exit":
-        client_socket.send("exit".encode())
-        break
+        # Receive data
+        message = protocol.recv_message(client_socket)
+        if message is None:
+            print("Server closed the connection.")
+            break
+        status, data = message
+        print("Received: " + data + "\n")
 
-    client_socket.send(" ".join(command).encode())
+    # Close the socket
+    client_socket.close()
 
-    # Receive data
-    data = client_socket.recv(1024)
-    print("Received: " + data.decode() + "\n")
 
-# Close the socket
-client_socket.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
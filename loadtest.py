@@ -0,0 +1,327 @@
+"""
+Load generator and soak test for server.py.
+
+Starts a server on a free port in a scratch directory (or uses --host/--port
+to target a running one), builds a tree of directories and files, then runs
+N simulated clients that issue a weighted mix of commands for a while.
+Reports per command latency (p50/p99), throughput, errors and the server's
+RSS over time, and finally asks the server to fsck its tree and memory map.
+
+    python loadtest.py --clients 16 --duration 30 --mix read=5,write=2,ls=2,touch=1,mv=1,rm=1
+"""
+
+import argparse
+import collections
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+import client
+
+OPERATIONS = ["touch", "write", "read", "ls", "mv", "rm"]
+DEFAULT_MIX = "read=5,write=2,ls=2,touch=1,mv=1,rm=1"
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        op, _, weight = item.partition("=")
+        if op not in OPERATIONS:
+            raise Exception(f"Unknown operation {op} in mix.")
+        weights[op] = int(weight or 1)
+    return weights
+
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def read_rss(pid: int) -> int or None:
+    """Resident set size of a process in KB, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class Stats:
+    """Latencies and errors collected by all the simulated clients"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+
+    def record(self, op: str, seconds: float, error: str = None):
+        with self.lock:
+            self.latencies[op].append(seconds)
+            if error is not None:
+                self.errors[op][error] += 1
+
+
+class Tree:
+    """The client side view of the generated tree, shared by the clients"""
+
+    def __init__(self, dirs: int, files: int):
+        self.lock = threading.Lock()
+        self.dirs = [f"load/d{i}" for i in range(dirs)]
+        self.files = [f"{random.choice(self.dirs)}/f{i}.txt" for i in range(files)]
+        self.counter = files
+
+    def random_dir(self, exclude: str = None) -> str:
+        return random.choice([d for d in self.dirs if d != exclude] or self.dirs)
+
+    def random_file(self) -> str or None:
+        with self.lock:
+            return random.choice(self.files) if self.files else None
+
+    def new_file(self) -> str:
+        with self.lock:
+            self.counter += 1
+            return f"{random.choice(self.dirs)}/f{self.counter}.txt"
+
+    def add(self, path: str):
+        with self.lock:
+            self.files.append(path)
+
+    def remove(self, path: str):
+        with self.lock:
+            if path in self.files:
+                self.files.remove(path)
+
+
+class SimulatedClient(threading.Thread):
+    def __init__(self, args, name: str, tree: Tree, stats: Stats, weights: Dict[str, int], deadline: float):
+        super().__init__(daemon=True)
+        self.args = args
+        self.name = name
+        self.tree = tree
+        self.stats = stats
+        self.ops = list(weights.keys())
+        self.weights = list(weights.values())
+        self.deadline = deadline
+        self.conn = None
+
+    def connect(self):
+        self.conn = client.Client(self.args.host, self.args.port, self.name, self.args.timeout)
+
+    def reconnect(self):
+        """Drops the current connection, so the server closes the files it
+        had open, and opens a new one"""
+        try:
+            self.conn.disconnect()
+        except OSError:
+            pass
+        self.connect()
+
+    def run(self):
+        self.connect()
+        while time.monotonic() < self.deadline:
+            op = random.choices(self.ops, self.weights)[0]
+            start = time.perf_counter()
+            error = None
+            try:
+                getattr(self, op)()
+            except client.ServerError as e:
+                error = str(e).splitlines()[0]
+            except socket.timeout:
+                # the server thread is stuck, most likely on a file lock
+                error = "timeout (server did not answer)"
+                self.reconnect()
+            except (ConnectionError, OSError) as e:
+                error = f"connection error: {e}"
+                self.reconnect()
+            self.stats.record(op, time.perf_counter() - start, error)
+        self.conn.disconnect()
+
+    def touch(self):
+        path = self.tree.new_file()
+        self.conn.touch(path)
+        self.tree.add(path)
+
+    def write(self):
+        path = self.tree.random_file()
+        if path is None:
+            return self.touch()
+        data = "".join(random.choices("abcdefghijklmnopqrstuvwxyz ", k=self.args.write_size))
+        # close even if the write failed so the file lock is not held
+        responses = self.conn.pipeline([("open", path, "w"), ("write", path, data)], raise_errors=False)
+        if not isinstance(responses[0], client.ServerError):
+            self.conn.close(path)
+        for response in responses:
+            if isinstance(response, client.ServerError):
+                raise response
+
+    def read(self):
+        path = self.tree.random_file()
+        if path is None:
+            return self.touch()
+        responses = self.conn.pipeline([("open", path, "r"), ("read", path), ("close", path)], raise_errors=False)
+        for response in responses:
+            if isinstance(response, client.ServerError):
+                raise response
+
+    def ls(self):
+        self.conn.ls(self.tree.random_dir())
+
+    def mv(self):
+        path = self.tree.random_file()
+        if path is None:
+            return self.touch()
+        # moving a file to the directory it is in only fails
+        dest = self.tree.random_dir(exclude=path.rsplit("/", 1)[0])
+        self.conn.mv(path, dest)
+        self.tree.remove(path)
+        self.tree.add(f"{dest}/{path.split('/')[-1]}")
+
+    def rm(self):
+        path = self.tree.random_file()
+        if path is None:
+            return self.touch()
+        self.tree.remove(path)
+        self.conn.rm(path)
+
+
+def sample_rss(pid: int, interval: float, samples: list, stop: threading.Event):
+    start = time.monotonic()
+    while not stop.is_set():
+        samples.append((time.monotonic() - start, read_rss(pid)))
+        stop.wait(interval)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, compression: str = None, blocks: int = None) -> subprocess.Popen:
+    """Runs server.py in a scratch directory so its state and log are not touched"""
+    workdir = tempfile.mkdtemp(prefix="fs-loadtest-")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), str(port)]
+    if compression is not None:
+        command.append(compression)
+    if blocks is not None:
+        command += ["--blocks", str(blocks)]
+    server = subprocess.Popen(
+        command,
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port), 0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise Exception("Server did not start.")
+
+
+def setup_tree(args, tree: Tree):
+    with client.Client(args.host, args.port, "loadtest-setup") as conn:
+        conn.pipeline([("mkdir", "load")] + [("mkdir", d) for d in tree.dirs], raise_errors=False)
+        conn.pipeline([("touch", f) for f in tree.files], raise_errors=False)
+
+
+def report(stats: Stats, elapsed: float, rss: list, fsck: str):
+    total = sum(len(v) for v in stats.latencies.values())
+    failed = sum(sum(c.values()) for c in stats.errors.values())
+    print(f"{'op':<8}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for op in OPERATIONS:
+        latencies = stats.latencies.get(op, [])
+        if len(latencies) == 0:
+            continue
+        print(f"{op:<8}{len(latencies):>8}{sum(stats.errors[op].values()):>8}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}")
+    print(f"\n{total} operations in {elapsed:.1f}s, {total / elapsed:.1f} ops/s, {failed} errors")
+
+    if failed > 0:
+        print("\nErrors:")
+        for op, counter in stats.errors.items():
+            for message, count in counter.most_common():
+                print(f"  {op}: {message} ({count})")
+
+    if len(rss) > 0:
+        print("\nServer RSS:")
+        for t, kb in rss:
+            print(f"  {t:6.1f}s  {'n/a' if kb is None else f'{kb} KB'}")
+
+    print("\nConsistency check:")
+    print(fsck)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and soak test for server.py")
+    parser.add_argument("--clients", type=int, default=8, help="number of simulated clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted operations, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--dirs", type=int, default=4, help="directories in the generated tree")
+    parser.add_argument("--files", type=int, default=8, help="files in the generated tree")
+    parser.add_argument("--write-size", type=int, default=16, help="characters per write")
+    parser.add_argument("--timeout", type=float, default=5, help="seconds before a request counts as hung")
+    parser.add_argument("--rss-interval", type=float, default=1, help="seconds between RSS samples")
+    parser.add_argument("--compression", default=None, help="codec for the started server, e.g. zlib")
+    # the server's own default of 16 blocks fills up within a second, after
+    # which only the out of memory path would be measured
+    parser.add_argument("--blocks", type=int, default=16384, help="memory blocks of the started server")
+    parser.add_argument("--host", default="localhost", help="server to target instead of starting one")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--server-pid", type=int, default=None, help="pid of the targeted server, for RSS")
+    args = parser.parse_args()
+
+    server = None
+    if args.port is None:
+        args.port = free_port()
+        server = start_server(args.port, args.compression, args.blocks)
+        args.server_pid = server.pid
+
+    try:
+        weights = parse_mix(args.mix)
+        tree = Tree(args.dirs, args.files)
+        setup_tree(args, tree)
+
+        stats = Stats()
+        rss = []
+        stop = threading.Event()
+        if args.server_pid is not None:
+            threading.Thread(target=sample_rss, args=(args.server_pid, args.rss_interval, rss, stop), daemon=True).start()
+
+        start = time.monotonic()
+        deadline = start + args.duration
+        clients = [SimulatedClient(args, f"loadtest-{i}", tree, stats, weights, deadline) for i in range(args.clients)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            # a client stuck past its timeout is reported through its errors
+            c.join(args.duration + args.timeout * 2)
+        elapsed = time.monotonic() - start
+        stop.set()
+
+        try:
+            with client.Client(args.host, args.port, "loadtest-fsck", args.timeout) as conn:
+                fsck = conn.fsck()
+        except client.ServerError as e:
+            fsck = f"INCONSISTENT\n{e}"
+        except (socket.timeout, OSError) as e:
+            fsck = f"fsck failed: {e}"
+
+        report(stats, elapsed, rss, fsck)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
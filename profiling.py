@@ -0,0 +1,201 @@
+"""
+Profiling for a running server, switched on and off by admin commands.
+
+SamplingProfiler samples the stacks of all threads from a background thread
+and writes them in the folded stack format ("frame;frame;frame count"),
+which flamegraph.pl, speedscope and most flame graph tools read.
+
+Tracer times every call to the methods of the given classes and writes the
+Chrome trace event format, which chrome://tracing and Perfetto open.
+
+Neither costs anything while it is off: the sampler thread only exists while
+profiling and the methods are only wrapped while tracing.
+"""
+
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List
+
+LOG_DIR = "logs"
+
+
+def log_path(kind: str, extension: str) -> str:
+    os.makedirs(LOG_DIR, exist_ok=True)
+    now = time.time()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+    return os.path.join(LOG_DIR, f"{kind}-{stamp}.{extension}")
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread each interval seconds"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.thread = None
+        self.timer = None
+        self.stopping = threading.Event()
+        self.stacks = Counter()
+        self.path = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, duration: float = None, interval: float = 0.005) -> str:
+        """Starts sampling, stops by itself after duration seconds if given (0 or
+        None for no limit).
+        Returns the path the profile will be written to."""
+        if not interval > 0:
+            raise Exception("Sampling interval must be positive.")
+        if duration is not None and not duration >= 0:
+            raise Exception("Duration must not be negative.")
+        with self.lock:
+            if self.running:
+                raise Exception("Profiler is already running.")
+            self.stacks = Counter()
+            self.stopping.clear()
+            self.path = log_path("profile", "folded")
+            self.thread = threading.Thread(target=self.__sample, args=(interval,), daemon=True)
+            self.thread.start()
+            if duration:
+                self.timer = threading.Timer(duration, self.expire, args=(self.path,))
+                self.timer.daemon = True
+                self.timer.start()
+            return self.path
+
+    def stop(self) -> str:
+        """Stops sampling and writes the profile, returns its path"""
+        with self.lock:
+            if not self.running:
+                raise Exception("Profiler is not running.")
+            self.stopping.set()
+            if self.timer is not None:
+                self.timer.cancel()
+            self.thread.join()
+            self.thread = None
+            self.timer = None
+
+            with open(self.path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            return self.path
+
+    def expire(self, path: str):
+        """Called by the timer, only stops the run that set it"""
+        with self.lock:
+            if self.running and self.path == path:
+                self.stop()
+
+    def __sample(self, interval: float):
+        me = threading.get_ident()
+        while not self.stopping.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                frames.reverse()
+                self.stacks[";".join(frames)] += 1
+
+
+class Tracer:
+    """Records the duration of every call to the methods of the given classes"""
+
+    def __init__(self, classes: List[type], max_events=1000000):
+        self.classes = classes
+        self.max_events = max_events
+        self.lock = threading.RLock()
+        self.originals = {}  # (class, name) -> the unwrapped function
+        self.events = []
+        self.dropped = 0
+        self.timer = None
+        self.path = None
+
+    @property
+    def running(self) -> bool:
+        return len(self.originals) > 0
+
+    def start(self, duration: float = None) -> str:
+        """Wraps the methods, unwraps them by itself after duration seconds if
+        given. Returns the path the trace will be written to.
+        Generator functions are left alone, their call returns at once and the
+        work happens while the caller iterates."""
+        if duration is not None and not duration >= 0:
+            raise Exception("Duration must not be negative.")
+        with self.lock:
+            if self.running:
+                raise Exception("Tracer is already running.")
+            self.events = []
+            self.dropped = 0
+            self.path = log_path("trace", "json")
+            for cls in self.classes:
+                for name, value in list(vars(cls).items()):
+                    # skip properties, and dunders like __init__ and __str__
+                    if not callable(value) or (name.startswith("__") and name.endswith("__")):
+                        continue
+                    if inspect.isgeneratorfunction(value):
+                        continue
+                    self.originals[(cls, name)] = value
+                    setattr(cls, name, self.__wrap(f"{cls.__name__}.{name.split('__')[-1]}", value))
+            if duration:
+                self.timer = threading.Timer(duration, self.expire, args=(self.path,))
+                self.timer.daemon = True
+                self.timer.start()
+            return self.path
+
+    def stop(self) -> str:
+        """Puts the original methods back and writes the trace, returns its path"""
+        with self.lock:
+            if not self.running:
+                raise Exception("Tracer is not running.")
+            for (cls, name), function in self.originals.items():
+                setattr(cls, name, function)
+            self.originals = {}
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = None
+
+            events = list(self.events)
+            pid = os.getpid()
+            with open(self.path, "w") as f:
+                # written by hand, one event per line, so a large trace does
+                # not have to be built as one string
+                f.write('{"displayTimeUnit": "ms", "otherData": {"dropped": %d}, "traceEvents": [\n' % self.dropped)
+                for i, (name, start, duration, tid) in enumerate(events):
+                    f.write('%s{"name": "%s", "cat": "fs", "ph": "X", "ts": %.3f, "dur": %.3f, "pid": %d, "tid": %d}\n'
+                            % ("," if i > 0 else "", name, start, duration, pid, tid))
+                f.write("]}\n")
+            return self.path
+
+    def expire(self, path: str):
+        """Called by the timer, only stops the run that set it"""
+        with self.lock:
+            if self.running and self.path == path:
+                self.stop()
+
+    def __wrap(self, name: str, function):
+        events = self.events
+        max_events = self.max_events
+        clock = time.perf_counter
+
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if len(events) < max_events:
+                    events.append((name, start * 1e6, (clock() - start) * 1e6, threading.get_ident()))
+                else:
+                    self.dropped += 1
+        return traced
@@ -0,0 +1,64 @@
+"""
+Wire format shared by the server and the clients.
+
+Every message is framed as a 5 byte header followed by the payload:
+    4 bytes - payload length (unsigned, big endian)
+    1 byte  - status, OK or ERROR (only meaningful for responses)
+
+Requests on one connection are answered in the order they were sent, so a
+client may pipeline several requests before reading the responses.
+"""
+
+import asyncio
+import socket
+import struct
+
+HEADER = struct.Struct("!IB")
+
+OK = 0
+ERROR = 1
+
+
+def encode_message(data: str, status: int = OK) -> bytes:
+    payload = data.encode()
+    return HEADER.pack(len(payload), status) + payload
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes or None:
+    """Receive exactly size bytes, returns None if the peer closed the connection"""
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock: socket.socket, data: str, status: int = OK):
+    sock.sendall(encode_message(data, status))
+
+
+def recv_message(sock: socket.socket):
+    """Receive one message, returns (status, data) or None if the connection closed"""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    size, status = HEADER.unpack(header)
+    payload = recv_exact(sock, size)
+    if payload is None:
+        return None
+    return status, payload.decode()
+
+
+async def read_message(reader: asyncio.StreamReader):
+    """asyncio version of recv_message"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        size, status = HEADER.unpack(header)
+        payload = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, OSError):
+        # a reset connection is as closed as one shut down cleanly
+        return None
+    return status, payload.decode()
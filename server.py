@@ -1,9 +1,30 @@
+import argparse
 import threading
 import socket
 import FileSystem
 import json
+import shlex
+import profiling
+import protocol
 
-fs = FileSystem.FileSystem()
+# usage: python server.py [port] [compression codec] [--blocks n] [--level n] [--threshold n] [--chunk-size n]
+parser = argparse.ArgumentParser(description="File system server")
+parser.add_argument("port", type=int, nargs="?", default=95)
+parser.add_argument("compression", nargs="?", default=None, choices=list(FileSystem.CODECS),
+                    help="codec for files of at least threshold characters")
+parser.add_argument("--blocks", type=int, default=16, help="memory blocks of 32 characters")
+parser.add_argument("--level", type=int, default=6, help="compression level of the codec")
+parser.add_argument("--threshold", type=int, default=64, help="characters before a file is compressed")
+parser.add_argument("--chunk-size", type=int, default=256, help="characters compressed together")
+args = parser.parse_args()
+port = args.port
+fs_options = dict(num_blocks=args.blocks, compression=args.compression, level=args.level,
+                  threshold=args.threshold, chunk_size=args.chunk_size)
+
+try:
+    fs = FileSystem.FileSystem(**fs_options)
+except Exception as e:
+    parser.error(str(e))
 
 class Logger:
     def __init__(self):
@@ -20,36 +41,110 @@ class Executor:
     Commands:
         mkdir <path> - creates a directory at path
         touch <path> - creates a file at path
-        ls <path> - lists the contents of the directory at path
-        mv <old_path> <new_path> - moves the file or directory at old_path to new_path
-        rm <path> - removes the file or directory at path
+        ls [path] [-n page_size] [-c cursor] - lists the contents of the directory at path
+        mv <old_path> <new_path> - moves the file or directory at old_path to new_path,
+            into new_path if it is a directory, otherwise renaming it
+        cp [-r] <old_path> <new_path> - copies the file, or with -r the directory, at old_path
+        rm [-r] <path> - removes the file, or with -r the directory, at path
         open <path> r/w - opens the file at path for reading or writing
         close <path> - closes the file at path
         write <data> - writes data to the file at opened path
-        read <path> - reads data from the file at opened path
-        visualize - prints the file system in a tree format
+        read <path> [offset] [size] - reads data from the file at opened path
+        vtree [path] [-d depth] [-s] [-n page_size] [-c cursor] - prints the file system
+            in a tree format, -s prints per directory counts instead
+        vmap [-s] [-n page_size] [-c cursor] - prints the memory map, -s prints
+            ranges of blocks instead of every block
+        Paged output ends with 'next: <cursor>' when there is more to show, the cursor
+            names the last entry shown so the next page carries on after it.
+        fsck - checks the tree and the memory map for inconsistencies
+
+    Admin commands:
+        profile start [seconds] [interval_ms] - samples the stacks of all threads until
+            stopped or for seconds, written to logs/ in the folded stack format
+        profile stop - stops the profiler and writes the profile
+        trace start [seconds] - times every FileSystem, MemoryMap and File method call
+            until stopped or for seconds, written to logs/ as a Chrome trace
+        trace stop - stops tracing and writes the trace
     """
 
+    # listings longer than this are split into pages unless -n is given
+    DEFAULT_PAGE_SIZE = 500
+    SWITCHES = ["-s", "-r"]
+    OPTIONS = ["-d", "-n", "-c"]
+
     def __init__(self):
         self.logger = Logger()
+        self.profiler = profiling.SamplingProfiler()
+        self.tracer = profiling.Tracer([FileSystem.FileSystem, FileSystem.MemoryMap, FileSystem.File])
 
     def __split_command(self, command):
         """split the command on whitespaces into a list, 
         also text within quotations is treated as a single element"""
-        command = command.split()
-        new_command = []
-        for i in command:
-            if i[0] == '"' and i[-1] == '"':
-                new_command.append(i[1:-1])
+        try:
+            return shlex.split(command)
+        except ValueError:
+            # unbalanced quotes, e.g. an apostrophe typed into the interactive
+            # client, fall back to splitting on whitespace
+            return [i[1:-1] if len(i) > 1 and i[0] == '"' and i[-1] == '"' else i for i in command.split()]
+
+    def __parse_options(self, args):
+        """split the arguments into positional ones and a dict of -x options"""
+        positional, options = [], {}
+        i = 0
+        while i < len(args):
+            if args[i] in self.SWITCHES:
+                options[args[i]] = True
+            elif args[i] in self.OPTIONS:
+                if i + 1 == len(args):
+                    raise Exception(f"Option {args[i]} needs a value.")
+                options[args[i]] = args[i + 1]
+                i += 1
             else:
-                new_command.append(i)
-        return new_command
+                positional.append(args[i])
+            i += 1
+
+        for option in ["-d", "-n"]:
+            if option in options:
+                try:
+                    options[option] = int(options[option])
+                except ValueError:
+                    raise Exception(f"Option {option} must be a number.")
+        return positional, options
+
+    def close_all(self, user: 'User'):
+        """Closes every file the user still has open, writers publish their drafts"""
+        for file, (mode, path) in list(user.open_files.items()):
+            try:
+                fs.close_file(file, mode)
+                self.logger.info(f"{user.name}: File {path} closed on disconnect.")
+            except Exception as e:
+                self.logger.error(f"{user.name}: {e}")
+        user.open_files.clear()
+
+    def __open_file(self, user: 'User', path, mode):
+        """The file the user opened at path in mode, other users' opens of
+        the same file do not count"""
+        file = user.find_open_file(fs.get_file(path), path)
+        if file is None or user.open_files[file][0] != mode:
+            raise Exception("File is not open for writing." if mode == "w" else "File is not open for reading.")
+        return file
+
+    def __number(self, value, name):
+        try:
+            return float(value)
+        except ValueError:
+            raise Exception(f"{name} must be a number.")
+
+    def __page(self, lines, options):
+        return FileSystem.paginate(lines, options.get("-n", self.DEFAULT_PAGE_SIZE))
 
     def execute(self, user: 'User', command):
+        """Runs the command, returns the response and whether it succeeded"""
         self.logger.info(f"{user.name}: {command}")
-        command = self.__split_command(command)
         response = ""
+        ok = True
         try:
+            command = self.__split_command(command)
             if command[0] == "mkdir":
                 fs.mkdir(command[1])
                 response = f"Directory {command[1]} created."
@@ -59,55 +154,143 @@ class Executor:
                 response = f"File {command[1]} created."
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "open":
-                fs.open(command[1], command[2])
+                # one open per file and user: a second one would overwrite the
+                # first in open_files, and a second w would wait on itself
+                if fs.get_file(command[1]) in user.open_files:
+                    raise Exception("File is already open.")
+                file = fs.open(command[1], command[2])
+                user.open_files[file] = (command[2], command[1])
                 response = f"File {command[1]} opened for {command[2]}."
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "close":
-                fs.close(command[1])
+                # only the user's own opens can be closed, closing by path
+                # alone would release whoever holds the file
+                file = user.find_open_file(fs.get_file(command[1]), command[1])
+                if file is None:
+                    raise Exception("File is not open.")
+                fs.close_file(file, user.open_files.pop(file)[0])
                 response = f"File {command[1]} closed."
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "write":
-                fs.write(command[1], command[2])
+                fs.write_file(self.__open_file(user, command[1], "w"), command[2])
                 response = f"Data written to file {command[1]}."
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "read":
-                response = fs.read(command[1])
+                try:
+                    offset = int(command[2]) if len(command) > 2 else 0
+                    size = int(command[3]) if len(command) > 3 else None
+                except ValueError:
+                    raise Exception("Offset and size must be numbers.")
+                response = fs.read_file(self.__open_file(user, command[1], "r"), offset, size)
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "ls":
-                response = fs.ls(command[1])
-                self.logger.info(f"{user.name}: {response}")
+                args, options = self.__parse_options(command[1:])
+                path = args[0] if len(args) > 0 else ""
+                response = self.__page(fs.iter_ls(path, options.get("-c")), options)
+                self.logger.info(f"{user.name}: Directory {path} listed.")
             elif command[0] == "mv":
                 fs.mv(command[1], command[2])
-                response = f"File {command[1]} moved to {command[2]}."
+                response = f"{command[1]} moved to {command[2]}."
+                self.logger.info(f"{user.name}: {response}")
+            elif command[0] == "cp":
+                args, options = self.__parse_options(command[1:])
+                fs.cp(args[0], args[1], "-r" in options)
+                response = f"{args[0]} copied to {args[1]}."
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "rm":
-                fs.delete(command[1])
-                response = f"File {command[1]} deleted."
+                args, options = self.__parse_options(command[1:])
+                fs.delete(args[0], "-r" in options)
+                response = f"{args[0]} deleted."
                 self.logger.info(f"{user.name}: {response}")
             elif command[0] == "vtree":
-                response = fs.visualise_tree()
+                args, options = self.__parse_options(command[1:])
+                path = args[0] if len(args) > 0 else ""
+                if "-s" in options:
+                    lines = fs.iter_tree_summary(path, options.get("-d"), options.get("-c"))
+                else:
+                    lines = fs.iter_tree(path, options.get("-d"), options.get("-c"))
+                response = self.__page(lines, options)
                 self.logger.info(f"{user.name}: Tree visualised.")
             elif command[0] == "vmap":
-                response = fs.visualise_mmap()
+                args, options = self.__parse_options(command[1:])
+                if "-s" in options:
+                    lines = fs.mmap.iter_summary(options.get("-c"))
+                else:
+                    lines = fs.mmap.iter_visualise(options.get("-c"))
+                response = self.__page(lines, options)
                 self.logger.info(f"{user.name}: Map visualised.")
+            elif command[0] == "fsck":
+                problems = fs.check_consistency()
+                if len(problems) > 0:
+                    raise Exception("\n".join(problems))
+                response = "File system is consistent."
+                self.logger.info(f"{user.name}: {response}")
+            elif command[0] == "profile":
+                if command[1] == "start":
+                    duration = self.__number(command[2], "Seconds") if len(command) > 2 else None
+                    interval = self.__number(command[3], "Interval") / 1000 if len(command) > 3 else 0.005
+                    path = self.profiler.start(duration, interval)
+                    response = f"Profiler started, writing to {path}."
+                elif command[1] == "stop":
+                    response = f"Profile written to {self.profiler.stop()}."
+                else:
+                    raise Exception("Usage: profile start [seconds] [interval_ms] | profile stop")
+                self.logger.info(f"{user.name}: {response}")
+            elif command[0] == "trace":
+                if command[1] == "start":
+                    duration = self.__number(command[2], "Seconds") if len(command) > 2 else None
+                    path = self.tracer.start(duration)
+                    response = f"Tracing started, writing to {path}."
+                elif command[1] == "stop":
+                    response = f"Trace written to {self.tracer.stop()}."
+                else:
+                    raise Exception("Usage: trace start [seconds] | trace stop")
+                self.logger.info(f"{user.name}: {response}")
             else:
                 raise Exception("Invalid command. Please try again.")
         except Exception as e:
             response = str(e)
+            ok = False
             self.logger.error(f"{user.name}: {response}")
         
-        return response
+        return response, ok
 
 class User:
     def __init__(self, name):
         self.name = name
         self.current_dir = ""
+        # File -> (mode, path it was opened at), keyed by the file itself so
+        # it can still be closed after it or a directory above it was moved
+        self.open_files = {}
+
+    def find_open_file(self, file, path):
+        """Returns the file the user means by path, the file now at path if
+        the user has it open, otherwise the one the user opened at path"""
+        if file in self.open_files:
+            return file
+        for open_file, (mode, opened_at) in self.open_files.items():
+            if opened_at == path:
+                return open_file
+        return None
 
     def __repr__(self):
         return self.name
 
 
 executor = Executor()
+state_lock = threading.Lock()  # one thread writes state.json at a time
+
+
+def store_state(user: User):
+    """Saves the tree to state.json, a failed save is logged rather than
+    ending the connection of the user that triggered it"""
+    try:
+        state = json.dumps(fs.store_state())
+        with state_lock:
+            with open("state.json", "w") as f:
+                f.write(state)
+    except Exception as e:
+        executor.logger.error(f"{user.name}: Could not store state: {e}")
 
 # A thread function to handle a client connection
 
@@ -115,28 +298,38 @@ executor = Executor()
 def handle_client(client_socket: socket.socket):
     # Do something with the client's data here
     info = client_socket.getpeername()
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     
-    name = client_socket.recv(1024).decode()
-    user = User(name)
+    message = protocol.recv_message(client_socket)
+    if message is None:
+        client_socket.close()
+        return
+    user = User(message[1])
     print(f"Client {info} connected as {user.name}")
 
     # send welcome message
-    client_socket.send(f"Welcome {user.name}!".encode())
+    protocol.send_message(client_socket, f"Welcome {user.name}!")
 
-    while True:
-        request = client_socket.recv(1024)
-        if request == b'exit':
-            executor.logger.info(f"{user.name}: Disconnected.")
-            break
-        
-        response = executor.execute(user, request.decode())
+    try:
+        while True:
+            # requests may be pipelined, they are answered one by one in order
+            message = protocol.recv_message(client_socket)
+            if message is None or message[1] == 'exit':
+                executor.logger.info(f"{user.name}: Disconnected.")
+                break
 
-        client_socket.send(response.encode())
+            response, ok = executor.execute(user, message[1])
 
-        with open("state.json", "w") as f:
-            json.dump(fs.store_state(), f)
+            protocol.send_message(client_socket, str(response),
+                                  protocol.OK if ok else protocol.ERROR)
 
-    client_socket.close()
+            store_state(user)
+    except OSError as e:
+        executor.logger.error(f"{user.name}: Connection lost: {e}")
+    finally:
+        # files left open would hold their locks and drafts forever
+        executor.close_all(user)
+        client_socket.close()
     print(f"Client {info} as {user.name} disconnected")
 
 
@@ -144,7 +337,7 @@ def handle_client(client_socket: socket.socket):
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 # Bind the socket to the address and port
-server_socket.bind(("localhost", 95))
+server_socket.bind(("localhost", port))
 
 # Listen for incoming connections
 server_socket.listen(5)
@@ -157,7 +350,7 @@ try:
 except Exception as e:
     print("No state found. Continuing with empty fs... ")
     print(str(e))
-    fs = FileSystem.FileSystem()
+    fs = FileSystem.FileSystem(**fs_options)
     
 
 while True: